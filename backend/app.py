@@ -1,19 +1,36 @@
 from functools import wraps
 from flask import Flask, jsonify, request, make_response, send_from_directory
+from flask.json.provider import JSONProvider
 from werkzeug.routing import Rule
 from mongolog import *
 import base64
 import datetime
+import time
 import jwt
-from util import get_random_subdomain
+from util import get_random_subdomain, is_valid_subdomain, SUBDOMAIN_LENGTH
 import re
-import json
+import orjson
 import os
+import threading
+from cachetools import LRUCache
 
 JWT_SECRET = os.getenv('JWT_SECRET', os.urandom(32))
 DOMAIN = os.getenv('DOMAIN', 'requestrepo.com')
+DOMAIN_SUFFIX = '.' + DOMAIN
+
+
+class ORJSONProvider(JSONProvider):
+    # jsonify and request.json go through orjson; the request listings
+    # returned to the UI are the largest JSON payloads the app produces
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 
 app = Flask(__name__, static_url_path='/public/static')
+app.json = ORJSONProvider(app)
 app.url_map.add(Rule('/', endpoint='index'))
 app.url_map.add(Rule('/<path:path>', endpoint='catch_all'))
 
@@ -52,8 +69,13 @@ def write_basic_file(subdomain):
         ''
     }
 
-    with open('pages/' + subdomain, 'w') as outfile:
-        json.dump(file_data, outfile)
+    with open('pages/' + subdomain, 'wb') as outfile:
+        outfile.write(orjson.dumps(file_data))
+
+
+def get_timestamp():
+    # UTC epoch seconds, without building a datetime per call
+    return int(time.time())
 
 
 def log_request(request, subdomain):
@@ -79,38 +101,82 @@ def log_request(request, subdomain):
     else:
         dic['query'] = ''
     dic['url'] = request.url
-    dic['date'] = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+    dic['date'] = get_timestamp()
 
     http_insert_into_db(dic)
 
 
 def get_subdomain_from_hostname(host):
-    subdomain = host[:-len(DOMAIN) - 1][-8:]
-    if not subdomain or not subdomain.isalnum():
+    host = host.lower()
+    if not host.endswith(DOMAIN_SUFFIX):
+        return None
+
+    subdomain = host[:-len(DOMAIN_SUFFIX)][-SUBDOMAIN_LENGTH:]
+    if not is_valid_subdomain(subdomain):
         return None
 
-    return subdomain.lower()
+    return subdomain
 
 
-def subdomain_response(request, subdomain):
-    log_request(request, subdomain)
+# Parsed responses are kept per worker up to PAGE_CACHE_BYTES of page files.
+# Entries are keyed by subdomain and remember the file's mtime and size, so
+# a saved response replaces the old entry instead of piling up next to it.
+# Pages above PAGE_CACHE_MAX_ENTRY are parsed from disk on every request.
+PAGE_CACHE_BYTES = 32 * 1024 * 1024
+PAGE_CACHE_MAX_ENTRY = 64 * 1024
+page_cache = LRUCache(maxsize=PAGE_CACHE_BYTES, getsizeof=lambda page: page[1])
+page_cache_lock = threading.Lock()
+
+
+def read_page(subdomain):
     data = {'raw': '', 'headers': [], 'status_code': 200}
-    if not os.path.exists('pages/' + subdomain):
-        write_basic_file(subdomain)
-    with open('pages/' + subdomain, 'r') as json_file:
+    with open('pages/' + subdomain, 'rb') as json_file:
         try:
-            data = json.load(json_file)
+            data = orjson.loads(json_file.read())
         except:
             pass
     try:
-        resp = make_response(base64.b64decode(data['raw']))
+        raw = base64.b64decode(data['raw'])
     except:
-        resp = make_response('')
-    resp.headers['server'] = 'requestrepo.com'
+        raw = b''
+    headers = []
     if 'headers' in data:
         for header in data['headers']:
-            resp.headers[header['header']] = header['value']
-    resp.status_code = data['status_code']
+            headers.append((header['header'], header['value']))
+    return raw, headers, data['status_code']
+
+
+def load_page(subdomain, stat):
+    # The decoded body and headers are never larger than the file itself,
+    # so st_size is what an entry is charged against the cache
+    version = (stat.st_mtime_ns, stat.st_size)
+    with page_cache_lock:
+        page = page_cache.get(subdomain)
+    if page != None and page[0] == version:
+        return page[2]
+
+    result = read_page(subdomain)
+    with page_cache_lock:
+        if stat.st_size <= PAGE_CACHE_MAX_ENTRY:
+            page_cache[subdomain] = (version, stat.st_size, result)
+        else:
+            page_cache.pop(subdomain, None)
+    return result
+
+
+def subdomain_response(request, subdomain):
+    log_request(request, subdomain)
+    try:
+        stat = os.stat('pages/' + subdomain)
+    except FileNotFoundError:
+        write_basic_file(subdomain)
+        stat = os.stat('pages/' + subdomain)
+    raw, headers, status_code = load_page(subdomain, stat)
+    resp = make_response(raw)
+    resp.headers['server'] = 'requestrepo.com'
+    for header, value in headers:
+        resp.headers[header] = value
+    resp.status_code = status_code
     return resp
 
 
@@ -123,8 +189,8 @@ def index():
 @app.endpoint('catch_all')
 @check_subdomain
 def catch_all(path):
-    subdomain = request.path[1:8 + 1].lower()
-    if len(subdomain) == 8 and subdomain.isalnum():
+    subdomain = request.path[1:SUBDOMAIN_LENGTH + 1].lower()
+    if is_valid_subdomain(subdomain):
         return subdomain_response(request, subdomain)
 
     response = send_from_directory('public', path, as_attachment=False)
@@ -170,7 +236,7 @@ def get_requests():
         time = int(time)
     http_requests = http_get_subdomain(subdomain, time)
     dns_requests = dns_get_subdomain(subdomain, time)
-    server_time = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+    server_time = get_timestamp()
     return jsonify({
         'http': http_requests,
         'dns': dns_requests,
@@ -206,10 +272,7 @@ def get_token():
 @app.route('/api/get_server_time')
 @check_subdomain
 def get_server_time():
-    return jsonify({
-        'date':
-        int(datetime.datetime.now(datetime.timezone.utc).timestamp())
-    })
+    return jsonify({'date': get_timestamp()})
 
 
 @app.route('/api/delete_request', methods=['POST'])
@@ -280,13 +343,13 @@ def update_file():
                         })
             else:
                 return jsonify({"error": "maximum of 30 headers"}), 401
-            with open('pages/' + subdomain, 'w') as outfile:
-                json.dump(
-                    {
+            with open('pages/' + subdomain, 'wb') as outfile:
+                outfile.write(
+                    orjson.dumps({
                         'headers': headers,
                         'raw': raw,
                         'status_code': status_code
-                    }, outfile)
+                    }))
         return jsonify({"msg": "Updated response"})
     return jsonify({"error": "Unauthorized"}), 401
 
@@ -2,7 +2,7 @@ import os
 import pymongo
 from bson.objectid import ObjectId
 import urllib.parse
-import base64
+import binascii
 import datetime
 
 if 'MONGODB_DATABASE' in os.environ:
@@ -38,6 +38,7 @@ ddns = db['ddns']
 
 # create indexes
 collection.create_index([('uid', 1), ('_deleted', 1), ('date', 1)], background=True)
+ddns.create_index([('domain', 1)], background=True)
 
 
 
@@ -83,22 +84,13 @@ def dns_get_subdomain(subdomain, time):
 
     for x in collection.find(find, {'_deleted': False}):
         x['_id'] = str(x['_id'])
-        x['raw'] = str(base64.b64encode(x['raw']), 'utf-8')
+        x['raw'] = binascii.b2a_base64(x['raw'], newline=False).decode('ascii')
         l.append(x)
     return l
 
 
-def dns_delete_records(subdomain):
-    ddns.delete_many({'subdomain': subdomain})
-
-
 def dns_delete_request(_id, subdomain):
-    collection.update_one({
-        'uid': subdomain,
-        '_id': ObjectId(_id)
-    }, {'$set': {
-        '_deleted': True
-    }})
+    collection.delete_one({'uid': subdomain, '_id': ObjectId(_id)})
 
 
 # HTTP database
@@ -116,7 +108,7 @@ def http_get_from_db():
     l = []
     for x in http.find({'_deleted': False}):
         x['_id'] = str(x['_id'])
-        x['raw'] = str(base64.b64encode(x['raw']), 'utf-8')
+        x['raw'] = binascii.b2a_base64(x['raw'], newline=False).decode('ascii')
         l.append(x)
     return l
 
@@ -134,18 +126,13 @@ def http_get_subdomain(subdomain, time):
     #for x in http.find(find, {'_id': False}):
     for x in http.find(find, {'_deleted': False}):
         x['_id'] = str(x['_id'])
-        x['raw'] = str(base64.b64encode(x['raw']), 'utf-8')
+        x['raw'] = binascii.b2a_base64(x['raw'], newline=False).decode('ascii')
         l.append(x)
     return l
 
 
 def http_delete_request(_id, subdomain):
-    http.update_one({
-        '_id': ObjectId(_id),
-        'uid': subdomain
-    }, {'$set': {
-        '_deleted': True
-    }})
+    http.delete_one({'_id': ObjectId(_id), 'uid': subdomain})
 
 
 # Users Database
@@ -3,7 +3,15 @@ import os
 
 SUBDOMAIN_ALPHABET = '0123456789abcdefghijklmnopqrstuvwxyz'
 SUBDOMAIN_LENGTH = int(os.environ.get('SUBDOMAIN_LENGTH', 8))
+SUBDOMAIN_CHARS = frozenset(SUBDOMAIN_ALPHABET)
 
 
 def get_random_subdomain():
-    return ''.join(random.choices(SUBDOMAIN_ALPHABET, k=SUBDOMAIN_LENGTH))
\ No newline at end of file
+    return ''.join(random.choices(SUBDOMAIN_ALPHABET, k=SUBDOMAIN_LENGTH))
+
+
+def is_valid_subdomain(subdomain):
+    # Unlike str.isalnum, only accepts characters get_random_subdomain can
+    # produce (no uppercase or non-ASCII digits)
+    return len(subdomain) == SUBDOMAIN_LENGTH and SUBDOMAIN_CHARS.issuperset(
+        subdomain)
\ No newline at end of file
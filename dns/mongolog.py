@@ -1,7 +1,8 @@
 import os
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument
 import urllib.parse
-import re
+import threading
+from cachetools import TTLCache
 
 if 'MONGODB_DATABASE' in os.environ:
     MONGODB_DATABASE = os.environ['MONGODB_DATABASE']
@@ -26,46 +27,80 @@ else:
 username = urllib.parse.quote_plus(MONGODB_USERNAME)
 password = urllib.parse.quote_plus(MONGODB_PASSWORD)
 
-def insert_into_db(value):
-    client = MongoClient('mongodb://%s:%s@%s' % (username, password, MONGODB_HOSTNAME), 27017)
-    db = client[MONGODB_DATABASE]
+# One pooled client shared by every resolver thread, instead of a new
+# connection (handshake + auth) per DNS query
+client = MongoClient('mongodb://%s:%s@%s' % (username, password, MONGODB_HOSTNAME), 27017, maxPoolSize=256)
+db = client[MONGODB_DATABASE]
 
-    collection = db['dns_requests']
-    value['_deleted'] = False
-    collection.insert_one(value)
-    client.close()
+collection = db['dns_requests']
+ddns = db['ddns']
+
+def insert_many_into_db(values):
+    for value in values:
+        value['_deleted'] = False
+    collection.insert_many(values, ordered=False)
+
+
+# Records are cached for a couple of seconds; a change made in the UI is
+# visible once the entry expires. Names without any record (mostly
+# scanners probing random subdomains) live in a separate, larger cache so
+# a flood of unique names cannot evict hot entries.
+_records = TTLCache(maxsize=10000, ttl=2)
+_missing_records = TTLCache(maxsize=200000, ttl=5)
+_cache_lock = threading.Lock()
+# One lock per name being fetched, so a burst of queries for an uncached
+# name results in a single database query
+_fetch_locks = {}
+
+def _get_cached_records(domain):
+    with _cache_lock:
+        if domain in _missing_records:
+            return {}
+        return _records.get(domain)
+
+
+def get_dns_records(domain):
+    # Every record type of a name is fetched in one query and keyed by type
+    records = _get_cached_records(domain)
+    if records != None:
+        return records
+
+    with _cache_lock:
+        fetch_lock = _fetch_locks.setdefault(domain, threading.Lock())
+    with fetch_lock:
+        records = _get_cached_records(domain)
+        if records != None:
+            return records
+        try:
+            records = {}
+            for x in ddns.find({'domain':domain}):
+                records.setdefault(x['type'], x)
+            with _cache_lock:
+                if records:
+                    _records[domain] = records
+                else:
+                    _missing_records[domain] = True
+        finally:
+            with _cache_lock:
+                _fetch_locks.pop(domain, None)
+    return records
 
 
 def get_dns_record(domain, dtype):
-    client = MongoClient('mongodb://%s:%s@%s' % (username, password, MONGODB_HOSTNAME), 27017)
-    db = client[MONGODB_DATABASE]
-
-    ddns = db['ddns']
-    result = ddns.find_one({'domain':domain, 'type':dtype})
-    client.close()
-    return result
-
-
-
-#REGXPRESSION = '^\\.?[0-9a-z]{8}\\.requestrepo\\.com\\.?$'
-REGXPRESSION = '^(.*)(\\.?[0-9a-z]{8}\\.requestrepo\\.com\\.?)$'
-def update_dns_record(subdomain, domain, dtype, newval):
-    client = MongoClient('mongodb://%s:%s@%s' % (username, password, MONGODB_HOSTNAME), 27017)
-    db = client[MONGODB_DATABASE]
-
-    ddns = db['ddns']
-    if subdomain == None:
-        uid = re.search(REGXPRESSION, domain)
-        if uid == None:
-            uid = "Bad"
-        else:
-            uid = uid.group(2)
-            if uid[0] == '.':
-                subdomain = uid[1:9]
-            else:
-                subdomain = uid[:8]
-    ddns.update_one({'subdomain':subdomain, 'domain':domain, 'type':dtype}, {'$set':{'value':newval}})
-    client.close()
+    return get_dns_records(domain).get(dtype)
+
+
+
+def rotate_dns_record(_id, idx):
+    # Atomically advance the round-robin counter of alternative idx and
+    # return its previous value, so concurrent queries never serve the same
+    # position twice and no read-modify-write of the value is needed
+    result = ddns.find_one_and_update({'_id':_id}, {'$inc':{'rotation.%d' % idx:1}},
+                                      projection={'rotation':True},
+                                      return_document=ReturnDocument.BEFORE)
+    if result == None:
+        return 0
+    return result.get('rotation', {}).get(str(idx), 0)
 
 #def insert_dns_record(subdomain, domain, dtype, val):
 #    ddns.insert_one({'subdomain':subdomain, 'domain':domain, 'type':dtype, 'value':val})
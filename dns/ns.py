@@ -3,14 +3,17 @@ import sys
 import datetime
 import time
 import os
-from time import sleep
-import re
 import random
+import functools
+import queue
+import threading
+import signal
+from concurrent.futures import ThreadPoolExecutor
 
 from dnslib import DNSLabel, QTYPE, RD, RR, RCODE
 from dnslib import A, AAAA, CNAME, MX, NS, SOA, TXT
-from dnslib.server import DNSServer
-from mongolog import insert_into_db, update_dns_record, get_dns_record
+from dnslib.server import DNSServer, UDPServer
+from mongolog import insert_many_into_db, rotate_dns_record, get_dns_record
 
 EPOCH = datetime.datetime(1970, 1, 1)
 SERIAL = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
@@ -99,121 +102,167 @@ if 'SERVER_IP' in os.environ:
 else:
     SERVER_IP = '127.0.0.1'
 
-#REGXPRESSION = '^\\.?[0-9a-z]{8}\\.requestrepo\\.com\\.?$'
-REGXPRESSION = '^(.+\\.)?(([0-9a-z]{8})\\.requestrepo\\.com\\.?)$'
+DOMAIN = os.getenv('DOMAIN', 'requestrepo.com')
+DOMAIN_SUFFIX = '.' + DOMAIN
 
+DEFAULT_CNAME = DOMAIN + '.'
+DEFAULT_TXT = '3r_c8OKexhD8zYQUx6QKjIlnkn6E_YB_vdzgZ5Xbpjk'
+
+
+# Log entries are written to the database by a background thread so DNS
+# answers never wait on the insert. The queue is bounded; when a flood
+# fills it, entries are dropped instead of delaying replies.
+LOG_QUEUE = queue.Queue(maxsize=10000)
+LOG_BATCH_SIZE = 500
+dropped_logs = 0
+dropped_logs_lock = threading.Lock()
+
+
+def save_into_db(reply, name, ip, raw):
+    global dropped_logs
+    date = int(time.time())
+    try:
+        LOG_QUEUE.put_nowait((reply, name, ip, raw, date))
+    except queue.Full:
+        with dropped_logs_lock:
+            dropped_logs += 1
+
+
+def get_subdomain(name):
+    # The UID is the 8 character label right before the domain, e.g.
+    # "x.abcd1234.requestrepo.com." -> "abcd1234"
+    name = name.lower()
+    if name.endswith('.'):
+        name = name[:-1]
+    if not name.endswith(DOMAIN_SUFFIX):
+        return "Bad"
+    uid = name[:-len(DOMAIN_SUFFIX)].rsplit('.', 1)[-1]
+    if len(uid) != 8 or not uid.isascii() or not uid.isalnum():
+        return "Bad"
+    return uid
 
-def save_into_db(reply, ip, raw):
-    name = str(reply.q.qname)
-    uid = re.search(REGXPRESSION, name.lower())
-    if uid == None:
-        uid = "Bad"
-    else:
-        uid = uid.group(3)
-        if uid[0] == '.':
-            uid = uid[1:9]
-        else:
-            uid = uid[:8]
 
-    data = {
-        "date": int(datetime.datetime.now(datetime.timezone.utc).timestamp()),
+def make_log_entry(reply, name, ip, raw, date):
+    return {
+        "date": date,
         "ip": ip,
         "type": QTYPE[reply.q.qtype],
         "name": name,
-        "uid": uid,
+        "uid": get_subdomain(name),
         "reply": str(reply),
         "raw": raw
     }
-    insert_into_db(data)
+
+
+def write_log_batch(batch):
+    global dropped_logs
+    while len(batch) < LOG_BATCH_SIZE:
+        try:
+            batch.append(LOG_QUEUE.get_nowait())
+        except queue.Empty:
+            break
+    if batch:
+        insert_many_into_db([make_log_entry(*entry) for entry in batch])
+    with dropped_logs_lock:
+        dropped, dropped_logs = dropped_logs, 0
+    if dropped:
+        print('Dropped {} DNS log entries, queue full'.format(dropped))
+
+
+def log_worker():
+    while True:
+        try:
+            write_log_batch([LOG_QUEUE.get()])
+        except Exception as ex:
+            print(ex)
+
+
+@functools.lru_cache(maxsize=4096)
+def cached_record(rdata_type, value):
+    # A Record carries no query name (the RR takes it from the question in
+    # try_rr), so one instance can answer every query for the same value
+    # instead of rebuilding the dnslib rdata each time
+    return Record(rdata_type, value)
+
+
+# Private generator: avoids going through the shared module-level instance
+_rng = random.Random()
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_round_robin(value):
+    # "a/b%c" -> (('a', 'b'), ('c',)): one of the %-separated alternatives
+    # is picked at random, then its /-separated addresses are rotated.
+    # Stored values rarely change, so almost every query is a cache hit.
+    return tuple(tuple(ips.split('/')) for ips in value.split('%'))
 
 
 class Resolver:
     def __init__(self):
         self.server_ip = SERVER_IP
+        # Answers for names without a custom record, built once. The server
+        # IP may not parse as both an A and an AAAA address; that record
+        # is then left out instead of failing on every query.
+        self.default_records = {
+            'CNAME': Record(CNAME, DEFAULT_CNAME),
+            'TXT': Record(TXT, DEFAULT_TXT),
+        }
+        for rdata_type, dtype in ((A, 'A'), (AAAA, 'AAAA')):
+            try:
+                self.default_records[dtype] = Record(rdata_type, self.server_ip)
+            except:
+                self.default_records[dtype] = None
+        self._dispatch = {
+            QTYPE.CNAME: self.resolve_cname,
+            QTYPE.TXT: self.resolve_txt,
+            QTYPE.A: lambda qname: self.resolve_ip(qname, A, 'A'),
+            QTYPE.AAAA: lambda qname: self.resolve_ip(qname, AAAA, 'AAAA'),
+        }
+
+    def resolve_cname(self, qname):
+        data = get_dns_record(qname, 'CNAME')
+        if data == None:
+            return self.default_records['CNAME']
+        return cached_record(CNAME, data['value'])
+
+    def resolve_txt(self, qname):
+        data = get_dns_record(qname, 'TXT')
+        if data == None:
+            return self.default_records['TXT']
+        return cached_record(TXT, data['value'])
+
+    def resolve_ip(self, qname, rdata_type, dtype):
+        data = get_dns_record(qname, dtype)
+        if data == None:
+            return self.default_records[dtype]
+
+        alternatives = parse_round_robin(data['value'])
+        idx = 0
+        if len(alternatives) > 1:
+            idx = _rng.randrange(len(alternatives))
+        ips = alternatives[idx]
+        if len(ips) == 1:
+            return cached_record(rdata_type, ips[0])
+
+        position = rotate_dns_record(data['_id'], idx)
+        return cached_record(rdata_type, ips[position % len(ips)])
 
     def resolve(self, request, handler):
         reply = request.reply()
 
         # We assume that the data in the DB is correct (using server side checks)
-        new_record = None
-
-        if QTYPE[reply.q.qtype] == 'CNAME':
-            data = get_dns_record(str(reply.q.qname), 'CNAME')
-            if data == None:
-                new_record = Record(CNAME, 'requestrepo.com.')
-            else:
-                new_record = Record(CNAME, data['value'])
-        elif QTYPE[reply.q.qtype] == 'TXT':
-            data = get_dns_record(str(reply.q.qname), 'TXT')
-            if data == None:
-                new_record = Record(
-                    TXT, '3r_c8OKexhD8zYQUx6QKjIlnkn6E_YB_vdzgZ5Xbpjk')
-            else:
-                new_record = Record(TXT, data['value'])
-        elif QTYPE[reply.q.qtype] == 'A':
-            data = get_dns_record(str(reply.q.qname), 'A')
-            if data == None:
-                new_record = Record(A, self.server_ip)
-            else:
-                ips = data['value']
-                if '/' not in ips and '%' not in ips:
-                    new_record = Record(A, ips)
-                else:
-                    if '%' in ips:
-                        ips = ips.split('%')
-                        idx = random.randint(0, len(ips) - 1)
-                        if '/' in ips[idx]:
-                            new_ips = ips[idx].split('/')
-                            new_record = Record(A, new_ips[0])
-                            new_ips = '/'.join(new_ips[1:] + [new_ips[0]])
-                            ips[idx] = new_ips
-                            ips = '%'.join(ips)
-                            update_dns_record(data['subdomain'],
-                                              data['domain'], 'A', ips)
-                        else:
-                            new_record = Record(A, ips[idx])
-                    else:
-                        ips = ips.split('/')
-                        new_record = Record(A, ips[0])
-                        ips = '/'.join(ips[1:] + [ips[0]])
-                        update_dns_record(data['subdomain'], data['domain'],
-                                          'A', ips)
-        elif QTYPE[reply.q.qtype] == 'AAAA':
-            data = get_dns_record(str(reply.q.qname), 'AAAA')
-            if data == None:
-                try:
-                    new_record = Record(AAAA, self.server_ip)
-                except:
-                    pass
-            else:
-                ips = data['value']
-                if '/' not in ips and '%' not in ips:
-                    new_record = Record(AAAA, ips)
-                else:
-                    if '%' in ips:
-                        ips = ips.split('%')
-                        idx = random.randint(0, len(ips) - 1)
-                        if '/' in ips[idx]:
-                            new_ips = ips[idx].split('/')
-                            new_record = Record(AAAA, new_ips[0])
-                            new_ips = '/'.join(new_ips[1:] + [new_ips[0]])
-                            ips[idx] = new_ips
-                            ips = '%'.join(ips)
-                            update_dns_record(data['subdomain'],
-                                              str(reply.q.qname), 'AAAA', ips)
-                        else:
-                            new_record = Record(AAAA, ips[idx])
-                    else:
-                        ips = ips.split('/')
-                        new_record = Record(AAAA, ips[0])
-                        ips = '/'.join(ips[1:] + [ips[0]])
-                        update_dns_record(data['subdomain'],
-                                          str(reply.q.qname), 'AAAA', ips)
+        fn = self._dispatch.get(reply.q.qtype)
+        if fn is None:
+            return reply
+        name = str(reply.q.qname)
+        # Records are stored lowercase; resolvers may randomize the case of
+        # the query name (0x20 encoding), so look up the lowered form
+        new_record = fn(name.lower())
 
         if new_record != None:
             reply.add_answer(new_record.try_rr(request.q))
             try:
-                save_into_db(reply, handler.client_address[0],
+                save_into_db(reply, name, handler.client_address[0],
                              handler.request[0])
             except Exception as ex:
                 print(ex)
@@ -222,21 +271,64 @@ class Resolver:
         return reply
 
 
+# UDP queries are answered by a fixed set of threads instead of spawning one
+# thread per packet. At most DNS_BACKLOG queries are running or waiting for
+# a worker; packets beyond that are dropped and the client retries.
+# TCP stays on dnslib's thread-per-connection TCPServer: its handler blocks
+# in recv() for as long as the client keeps the connection open, so idle
+# connections would otherwise take every worker and stall UDP resolution.
+DNS_WORKERS = int(os.environ.get('DNS_WORKERS', 64))
+DNS_BACKLOG = int(os.environ.get('DNS_BACKLOG', DNS_WORKERS * 16))
+WORKERS = ThreadPoolExecutor(max_workers=DNS_WORKERS)
+
+
+class PooledUDPServer(UDPServer):
+    slots = threading.BoundedSemaphore(DNS_BACKLOG)
+
+    def process_request(self, request, client_address):
+        if not self.slots.acquire(blocking=False):
+            return
+        try:
+            WORKERS.submit(self.process_pooled, request, client_address)
+        except RuntimeError:
+            # pool already shut down
+            self.slots.release()
+
+    def process_pooled(self, request, client_address):
+        try:
+            self.process_request_thread(request, client_address)
+        finally:
+            self.slots.release()
+
+
 resolver = Resolver()
 servers = [
     DNSServer(resolver, port=53, address='0.0.0.0', tcp=True),
-    DNSServer(resolver, port=53, address='0.0.0.0', tcp=False),
+    DNSServer(resolver,
+              port=53,
+              address='0.0.0.0',
+              tcp=False,
+              server=PooledUDPServer),
 ]
 
 if __name__ == '__main__':
+    threading.Thread(target=log_worker, daemon=True).start()
     for s in servers:
         s.start_thread()
 
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
     try:
-        while 1:
-            sleep(0.1)
+        stop_event.wait()
     except KeyboardInterrupt:
         pass
     finally:
         for s in servers:
             s.stop()
+        # Queries still waiting for a worker are dropped; the ones already
+        # running finish so their log entries are queued before the flush.
+        # TCP connections run on dnslib's daemon threads and are not waited
+        # for, so an idle client cannot hold up shutdown.
+        WORKERS.shutdown(wait=True, cancel_futures=True)
+        while not LOG_QUEUE.empty():
+            write_log_batch([])